@@ -1,6 +1,9 @@
+import os
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
+import uvicorn
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 @app.post("/tools/get_employee_count")
 def get_employee_count():
@@ -12,3 +15,8 @@ def get_employee_count():
     return {
         "employee_count": 120
     }
+
+
+if __name__ == "__main__":
+    # uvloop + httptools are the fast event loop / HTTP parser for uvicorn
+    uvicorn.run("Mcp_server:app", host="127.0.0.1", port=8000, loop="uvloop", http="httptools", workers=os.cpu_count())
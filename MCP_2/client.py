@@ -1,12 +1,18 @@
 import requests
+from requests.adapters import HTTPAdapter
+
+# Reuse one connection to the MCP server instead of reconnecting per call
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
 
 def ask_llm(question):
     print(f"\nUser Question: {question}")
 
     print("LLM: I need data. Calling MCP tool...")
 
-    response = requests.post(
-        "http://localhost:8000/tools/get_employee_count"
+    response = SESSION.post(
+        "http://localhost:8000/tools/get_employee_count",
+        timeout=30
     )
 
     data = response.json()
@@ -1,7 +1,16 @@
 import os
-import json
-import requests
-from openai import OpenAI
+import re
+import hashlib
+from collections import OrderedDict
+import orjson
+import asyncio
+import httpx
+import openai
+from openai import AsyncOpenAI
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+from llm_context import build_context_for_llm
+from routing import route_locally
 
 # Load .env into environment if python-dotenv is installed so OPENAI_API_KEY in .env is picked up
 try:
@@ -18,10 +27,42 @@ if not api_key:
         "OPENAI_API_KEY not set. Install python-dotenv and add a .env file with OPENAI_API_KEY=sk-... or export the variable in your shell."
     )
 
-client = OpenAI(api_key=api_key)
+# Our own HTTP client for OpenAI so its connection pool can be pre-warmed (see _prewarm)
+OPENAI_HTTP = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=httpx.Timeout(600, connect=5)
+)
+
+# Retries are handled by _create_completion below, so the SDK's own retry loop is disabled
+AOPENAI = AsyncOpenAI(api_key=api_key, max_retries=0, http_client=OPENAI_HTTP)
 
 MCP_BASE = "http://localhost:8000/tools"
 
+# Matches "from <sender>" in a question; used when the LLM omits search arguments
+_FROM_RE = re.compile(r"from\s+([\w\s.\-@]+)", re.I)
+_SENDER_STRIP = '\"\'?.'
+
+# Upper bound on the tool context sent to the answering LLM call
+_CONTEXT_CHARS = 6000
+
+# Caps on in-flight calls per external dependency, so concurrent questions
+# don't trip provider rate limits
+_OPENAI_SEM = asyncio.Semaphore(8)
+_MCP_SEM = asyncio.Semaphore(16)
+
+# Small in-process LRU caches: question -> routing decision, and
+# (question, tool, tool output) -> final answer.
+_CACHE_SIZE = 1024
+_ROUTE_CACHE: "OrderedDict[str, tuple]" = OrderedDict()
+_ANSWER_CACHE: "OrderedDict[str, str]" = OrderedDict()
+
+# Shared async HTTP client so the TCP connection to the MCP server is kept alive
+# between tool calls (and across questions in interactive/batch mode).
+ASYNC_CLIENT = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=30
+)
+
 TOOL_DESCRIPTORS = [
     {
         "type": "function",
@@ -50,235 +91,318 @@ TOOL_DESCRIPTORS = [
 ]
 
 
-def ask_llm(question: str):
-    print(f"\nUser: {question}")
+_BACKOFF = wait_exponential_jitter(initial=1, max=30)
 
-    # Ask the LLM whether a tool is required and which one
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "You are an assistant that can call tools to access the user's Gmail. "
-                    "If you need email data to answer, call exactly one of the available tools: "
-                    "get_unread_emails, search_emails, or get_email_full."
-                )
-            },
-            {"role": "user", "content": question}
-        ],
-        tools=TOOL_DESCRIPTORS,
-        max_tokens=1000
-    )
+
+def _wait_retry_after(retry_state) -> float:
+    """Wait for the server's Retry-After when it sent one, else exponential backoff with jitter."""
+    exc = retry_state.outcome.exception()
+    response = getattr(exc, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), 60.0)
+    except (TypeError, ValueError):
+        return _BACKOFF(retry_state)
+
+
+@retry(
+    retry=retry_if_exception_type((openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+async def _create_completion(**kwargs):
+    return await AOPENAI.chat.completions.create(**kwargs)
+
+
+def _cache_key(*parts) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _cache_get(cache: OrderedDict, key: str):
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+
+def _cache_put(cache: OrderedDict, key: str, value) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > _CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+async def _route_with_llm(question: str):
+    """Ask the LLM whether a tool is required and which one.
+
+    Returns (tool_name, args, direct_answer). tool_name is None when the model
+    answered directly (direct_answer) or when no usable tool call could be built.
+    Decisions are cached per question.
+    """
+    key = _cache_key(question)
+    cached = _cache_get(_ROUTE_CACHE, key)
+    if cached is not None:
+        return cached
+
+    async with _OPENAI_SEM:
+        response = await _create_completion(
+            model="gpt-4o-mini",
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "You are an assistant that can call tools to access the user's Gmail. "
+                        "If you need email data to answer, call exactly one of the available tools: "
+                        "get_unread_emails, search_emails, or get_email_full."
+                    )
+                },
+                {"role": "user", "content": question}
+            ],
+            tools=TOOL_DESCRIPTORS,
+            max_tokens=1000
+        )
 
     message = response.choices[0].message
 
-    # If the model decided to call a tool, perform the request to the MCP server and then summarize
-    if getattr(message, "tool_calls", None):
-        tool_call = message.tool_calls[0]
+    # Model answered directly without calling tools
+    if not getattr(message, "tool_calls", None):
+        _cache_put(_ROUTE_CACHE, key, (None, None, message.content))
+        return None, None, message.content
 
-        # Robustly extract tool name and raw arguments since different SDK versions
-        # may expose different attributes on the tool_call object.
-        tool_name = None
-        raw_args = None
-        tc_dict = {}
+    fn = message.tool_calls[0].function
+    tool_name = fn.name
+    raw_args = fn.arguments
 
-        # Try to get a raw dict representation first (pydantic objects may support model_dump/dict)
-        try:
-            if hasattr(tool_call, "model_dump"):
-                tc_dict = tool_call.model_dump()
-            elif hasattr(tool_call, "dict"):
-                tc_dict = tool_call.dict()
-            else:
-                try:
-                    tc_dict = dict(tool_call)
-                except Exception:
-                    tc_dict = {}
-        except Exception:
-            tc_dict = {}
-
-        # Try common attribute names on the tool_call object
-        for attr in ("name", "tool", "function", "tool_name"):
-            val = getattr(tool_call, attr, None)
-            if val:
-                tool_name = val
-                break
-
-        raw_args = getattr(tool_call, "arguments", None) or getattr(tool_call, "args", None)
-
-        # Prefer values from the dict/model_dump when available (avoids getting a repr like "Function(...)")
-        try:
-            dict_name = tc_dict.get("name") or tc_dict.get("tool") or (tc_dict.get("function") if isinstance(tc_dict.get("function"), str) else None)
-            dict_args = tc_dict.get("arguments") or tc_dict.get("args") or tc_dict.get("arguments_json")
-            if dict_name:
-                tool_name = dict_name
-            if dict_args is not None and raw_args is None:
-                raw_args = dict_args
-        except Exception:
-            pass
-
-        # If tool_name is nested (object/dict), try to extract inner name
-        if isinstance(tool_name, dict):
-            tool_name = tool_name.get("name") or tool_name.get("tool")
-        elif tool_name is not None and not isinstance(tool_name, str):
-            # object with attribute 'name' or convertible to dict
-            name_attr = getattr(tool_name, "name", None)
-            if name_attr:
-                tool_name = name_attr
-            else:
-                try:
-                    if hasattr(tool_name, "model_dump"):
-                        tcd = tool_name.model_dump()
-                    elif hasattr(tool_name, "dict"):
-                        tcd = tool_name.dict()
-                    else:
-                        tcd = dict(tool_name)
-                    tool_name = tcd.get("name") or tcd.get("tool") or str(tool_name)
-                except Exception:
-                    tool_name = str(tool_name)
-
-        # If raw_args is an object, try to convert to dict or string; if missing, read from tc_dict
-        if raw_args is None:
-            raw_args = tc_dict.get("arguments") or tc_dict.get("args") or tc_dict.get("arguments_json")
-        elif raw_args is not None and not isinstance(raw_args, (str, dict, list)):
-            try:
-                if hasattr(raw_args, "model_dump"):
-                    raw_args = raw_args.model_dump()
-                elif hasattr(raw_args, "dict"):
-                    raw_args = raw_args.dict()
-                else:
-                    raw_args = dict(raw_args)
-            except Exception:
-                raw_args = str(raw_args)
-
-        # Final normalization: if tool_name still not a plain function name, try to parse from repr
-        try:
-            import re
-            if isinstance(tool_name, str):
-                # common reprs contain 'Function(... name='foo')' or "Function(name='foo', ...)"
-                if re.search(r"\bFunction\(|\bfunction\(|\bToolCall\(|\bChatCompletion", tool_name):
-                    m = re.search(r"name=[\'\"]?([A-Za-z0-9_\-]+)[\'\"]?", tool_name)
-                    if m:
-                        tool_name = m.group(1)
-                    else:
-                        # fallback: look for the last identifier-like token
-                        m2 = re.search(r"([A-Za-z0-9_\-]+)\)\s*$", tool_name)
-                        if m2:
-                            tool_name = m2.group(1)
+    if not tool_name:
+        print("Could not determine tool name from LLM response.")
+        return None, None, None
+
+    # arguments are a JSON string
+    try:
+        args = orjson.loads(raw_args) if raw_args else {}
+    except orjson.JSONDecodeError:
+        args = {}
+
+    # If the LLM didn't provide arguments, build sensible defaults per tool.
+    if not args:
+        if tool_name == "search_emails":
+            # Try to extract a sender using a simple "from <name>" pattern, otherwise use the whole question as query
+            m = _FROM_RE.search(question)
+            if m:
+                sender = m.group(1).strip().strip(_SENDER_STRIP)
+                query = f'from:"{sender}"'
             else:
-                rep = str(tool_name)
-                m = re.search(r"\bname=[\'\"]?([A-Za-z0-9_\-]+)", rep)
-                if m:
-                    tool_name = m.group(1)
-                else:
-                    tool_name = rep
-        except Exception:
-            try:
-                tool_name = str(tool_name)
-            except Exception:
-                tool_name = None
-
-        # Ensure sane defaults
-        if not tool_name:
-            print("Could not determine tool name from LLM response.")
-            return
+                query = question
+            args = {"query": query, "max_results": 5}
+        elif tool_name == "get_unread_emails":
+            args = {"max_results": 5}
+        elif tool_name == "get_email_full":
+            # get_email_full requires a message_id; we can't proceed without it
+            print("Tool get_email_full requires a message_id. Please ask to open a specific email or search first.")
+            return None, None, None
+
+    _cache_put(_ROUTE_CACHE, key, (tool_name, args, None))
+    return tool_name, args, None
+
+
+async def _call_mcp_tool(tool_name: str, args: dict):
+    """POST to the MCP server endpoint for tool_name and return the raw JSON response text."""
+    endpoint = f"{MCP_BASE}/{tool_name}"
+
+    # POST JSON body when arguments provided, otherwise simple POST
+    async with _MCP_SEM:
+        if args:
+            resp = await ASYNC_CLIENT.post(endpoint, json=args)
+        else:
+            resp = await ASYNC_CLIENT.post(endpoint)
+    resp.raise_for_status()
+    return resp.text
 
-        # arguments might be a JSON string
-        try:
-            args = json.loads(raw_args) if isinstance(raw_args, str) else (raw_args or {})
-        except Exception:
-            args = {}
-
-        # If the LLM didn't provide arguments, build sensible defaults per tool.
-        if not args:
-            if tool_name == "search_emails":
-                # Try to extract a sender using a simple "from <name>" pattern, otherwise use the whole question as query
-                try:
-                    import re
-                    m = re.search(r"from\s+([\w\s\.\-@]+)", question, re.I)
-                    if m:
-                        sender = m.group(1).strip().strip('\"\'?.')
-                        query = f'from:"{sender}"'
-                    else:
-                        query = question
-                except Exception:
-                    query = question
-                args = {"query": query, "max_results": 5}
-            elif tool_name == "get_unread_emails":
-                args = {"max_results": 5}
-            elif tool_name == "get_email_full":
-                # get_email_full requires a message_id; we can't proceed without it
-                print("Tool get_email_full requires a message_id. Please ask to open a specific email or search first.")
-                return
 
-        print(f"LLM decided to call MCP tool: {tool_name} with args={args}")
+def _build_tool_context(tool_name: str, tool_output: str) -> str:
+    """Condense the MCP server's JSON response into a short plain-text context for the LLM.
+
+    Full emails use build_context_for_llm; list/search results become one line per
+    message. Anything else is passed through. The result is capped at _CONTEXT_CHARS.
+    """
+    try:
+        data = orjson.loads(tool_output)
+    except orjson.JSONDecodeError:
+        return tool_output[:_CONTEXT_CHARS]
+
+    if tool_name == "get_email_full":
+        context = build_context_for_llm(data)
+    elif tool_name in ("get_unread_emails", "search_emails"):
+        rows = data.get("emails") or data.get("results") or []
+        lines = [f"{len(rows)} message(s)", "Subject | From | Date | id | snippet"]
+        for row in rows:
+            headers = row.get("headers") or {}
+            lines.append(
+                f"{headers.get('Subject', '(no subject)')} | {headers.get('From', '(unknown sender)')} | "
+                f"{headers.get('Date', '(unknown date)')} | {row.get('id')} | {(row.get('snippet') or '')[:200]}"
+            )
+        context = "\n".join(lines)
+    else:
+        context = tool_output
 
-        # Map tool name to endpoint
-        endpoint = f"{MCP_BASE}/{tool_name}"
+    return context[:_CONTEXT_CHARS]
 
-        try:
-            # POST JSON body when arguments provided, otherwise simple POST
-            if args:
-                resp = requests.post(endpoint, json=args)
-            else:
-                resp = requests.post(endpoint)
-            resp.raise_for_status()
-            data = resp.json()
-        except Exception as e:
-            print("Error calling MCP tool:", e)
-            return
 
-        # Ask the LLM to answer the original question using the tool output
-        final = client.chat.completions.create(
+async def _answer_with_tool_output(question: str, tool_name: str, tool_output: str, stream_output: bool):
+    """Ask the LLM to answer the original question using the tool output, and print it.
+
+    tool_output is the MCP server's JSON response text; it is condensed before prompting.
+    """
+    context = _build_tool_context(tool_name, tool_output)
+    key = _cache_key(question, tool_name, context)
+    cached = _cache_get(_ANSWER_CACHE, key)
+    if cached is not None:
+        print("\nFinal Answer:" if stream_output else f"\nFinal Answer ({question}):")
+        print(cached)
+        return
+
+    # The slot is held while the answer streams, since the request is still in flight
+    async with _OPENAI_SEM:
+        final = await _create_completion(
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "You are an assistant that answers the user's question using the provided tool output. Be concise and include summaries when appropriate."},
                 {"role": "user", "content": f"User question: {question}"},
-                {"role": "user", "content": f"Tool ({tool_name}) output:\n{json.dumps(data, indent=2)}"}
+                {"role": "user", "content": f"Tool ({tool_name}) output:\n{context}"}
             ],
-            max_tokens=1500
+            max_tokens=1500,
+            stream=True
         )
 
-        print("\nFinal Answer:")
-        print(final.choices[0].message.content)
+        # Print tokens as they arrive; when several questions run concurrently,
+        # buffer the answer instead so outputs don't interleave.
+        parts = []
+        if stream_output:
+            print("\nFinal Answer:")
+            async for chunk in final:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    print(delta, end="", flush=True)
+            print()
+        else:
+            async for chunk in final:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+            print(f"\nFinal Answer ({question}):")
+            print("".join(parts))
+
+    _cache_put(_ANSWER_CACHE, key, "".join(parts))
+
+
+async def ask_llm(question: str, stream_output: bool = True):
+    print(f"\nUser: {question}")
+
+    # Obvious intents skip the routing LLM call entirely
+    routed = route_locally(question)
+    if routed:
+        tool_name, args = routed
+        print(f"Routed locally to MCP tool: {tool_name} with args={args}")
     else:
-        # Model answered directly without calling tools
-        print("LLM Answer:")
-        print(message.content)
+        tool_name, args, direct_answer = await _route_with_llm(question)
+        if not tool_name:
+            if direct_answer is not None:
+                print("LLM Answer:")
+                print(direct_answer)
+            return
+        print(f"LLM decided to call MCP tool: {tool_name} with args={args}")
 
+    try:
+        tool_output = await _call_mcp_tool(tool_name, args)
+    except Exception as e:
+        print("Error calling MCP tool:", e)
+        return
 
-if __name__ == "__main__":
+    await _answer_with_tool_output(question, tool_name, tool_output, stream_output)
+
+
+async def _prewarm():
+    """Open a keep-alive connection to OpenAI so the first real call skips the TCP+TLS handshake."""
+    try:
+        await OPENAI_HTTP.head(str(AOPENAI.base_url.join("models")))
+    except httpx.HTTPError:
+        pass
+
+
+async def _ask_many(qs):
+    """Answer several questions concurrently; one failing question doesn't abort the others."""
+    results = await asyncio.gather(*[ask_llm(q, stream_output=len(qs) == 1) for q in qs], return_exceptions=True)
+    for q, result in zip(qs, results):
+        if isinstance(result, Exception):
+            print(f"\nError answering '{q}': {result}")
+
+
+def _shutdown(loop):
+    """Cancel leftover tasks (e.g. the warm-up or an interrupted question) and close the HTTP clients."""
+    pending = asyncio.all_tasks(loop)
+    for task in pending:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+    loop.run_until_complete(ASYNC_CLIENT.aclose())
+    loop.run_until_complete(AOPENAI.close())
+    loop.close()
+
+
+def main(argv=None):
     import argparse
     import sys
 
     parser = argparse.ArgumentParser(description="Ask questions about your Gmail using LLM + MCP tools")
     parser.add_argument("question", nargs="*", help="The question to ask (omit to enter interactive mode)")
-    args = parser.parse_args()
-
-    # If question provided on CLI, use it
-    if args.question:
-        q = " ".join(args.question)
-        ask_llm(q)
-        sys.exit(0)
-
-    # If piped via stdin, read entire stdin as the question
-    if not sys.stdin.isatty():
-        q = sys.stdin.read().strip()
-        if q:
-            ask_llm(q)
-        else:
-            print("No question provided on stdin.")
-        sys.exit(0)
+    args = parser.parse_args(argv)
+
+    # One event loop for the whole session so the keep-alive pools survive between
+    # questions. input() runs outside the loop, so Ctrl-C at the prompt is a plain
+    # KeyboardInterrupt rather than a cancellation of the next question.
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    # Runs alongside parsing/local routing/the MCP call of the first question
+    warm = loop.create_task(_prewarm())
 
-    # Otherwise enter interactive prompt
-    print("Entering interactive mode. Type 'exit' or 'quit' to leave.")
     try:
-        while True:
-            q = input("\nQuestion> ").strip()
-            if not q:
-                continue
-            if q.lower() in ("exit", "quit"):
-                break
-            ask_llm(q)
-    except (KeyboardInterrupt, EOFError):
-        print("\nExiting.")
+        # If question provided on CLI, use it
+        if args.question:
+            loop.run_until_complete(ask_llm(" ".join(args.question)))
+            return
+
+        # If piped via stdin, treat each non-empty line as a question and ask them concurrently
+        if not sys.stdin.isatty():
+            qs = [line.strip() for line in sys.stdin.read().splitlines() if line.strip()]
+            if qs:
+                loop.run_until_complete(_ask_many(qs))
+            else:
+                print("No question provided on stdin.")
+            return
+
+        # Otherwise enter interactive prompt
+        print("Entering interactive mode. Type 'exit' or 'quit' to leave.")
+        # The loop is idle while input() waits, so let the warm-up finish before the first prompt
+        loop.run_until_complete(asyncio.wait({warm}, timeout=3))
+        try:
+            while True:
+                q = input("\nQuestion> ").strip()
+                if not q:
+                    continue
+                if q.lower() in ("exit", "quit"):
+                    break
+                loop.run_until_complete(ask_llm(q))
+        except (KeyboardInterrupt, EOFError):
+            print("\nExiting.")
+    finally:
+        _shutdown(loop)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,202 @@
 from gmail_auth import get_gmail_service
+from llm_context import build_context_for_llm  # re-exported for existing callers
+import asyncio
 import base64
-from typing import List, Dict, Any
+import json
+import os
+import threading
+from typing import List, Dict, Any, Tuple
+
+from cachetools import TTLCache
+from googleapiclient.errors import HttpError
+from tenacity import Retrying, retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+
+_local = threading.local()
+
+# Message contents never change for a given id, so full emails are cached in-process.
+_EMAIL_CACHE: TTLCache = TTLCache(maxsize=512, ttl=900)
+_EMAIL_CACHE_LOCK = threading.Lock()
+
+# Cap on concurrent Gmail tool calls from async callers, to stay under Gmail's quota
+_GMAIL_SEM = asyncio.Semaphore(5)
+
+
+def _service():
+    """Build the Gmail service once per thread instead of on every tool call.
+
+    The service's underlying httplib2 connection is not thread-safe, and the
+    MCP server runs these tools from a thread pool, so each thread keeps its own.
+    """
+    service = getattr(_local, "service", None)
+    if service is None:
+        service = _local.service = get_gmail_service()
+    return service
+
+
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+_RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+_BACKOFF = wait_exponential_jitter(initial=1, max=30)
+_MAX_ATTEMPTS = 5
+
+# Gmail accepts at most 100 calls in a single batch request.
+_BATCH_LIMIT = 100
+
+
+def _error_reasons(exc: HttpError) -> set:
+    """The "reason" codes from a Gmail JSON error body (e.g. userRateLimitExceeded)."""
+    try:
+        error = json.loads(exc.content)["error"]
+    except (ValueError, KeyError, TypeError):
+        return set()
+    return {e.get("reason") for e in error.get("errors", []) if isinstance(e, dict)}
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if not isinstance(exc, HttpError):
+        return False
+    if exc.resp.status in _RETRYABLE_STATUSES:
+        return True
+    # Gmail reports rate limits as 403 with reason rateLimitExceeded / userRateLimitExceeded
+    return exc.resp.status == 403 and bool(_error_reasons(exc) & _RATE_LIMIT_REASONS)
+
+
+def _wait_retry_after(retry_state) -> float:
+    """Wait for Gmail's Retry-After when it sent one, else exponential backoff with jitter."""
+    exc = retry_state.outcome.exception()
+    try:
+        return min(float(exc.resp.get("retry-after")), 60.0)
+    except (AttributeError, TypeError, ValueError):
+        return _BACKOFF(retry_state)
+
+
+_RETRY_POLICY = dict(
+    retry=retry_if_exception(_is_retryable),
+    wait=_wait_retry_after,
+    stop=stop_after_attempt(_MAX_ATTEMPTS),
+    reraise=True
+)
+
+
+@retry(**_RETRY_POLICY)
+def _execute(request):
+    """Execute a Gmail API request, retrying rate limits and transient server errors."""
+    return request.execute()
+
+
+def _batch_execute(service, requests: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Exception]]:
+    """Run many Gmail requests, keyed by id, as batch HTTP requests.
+
+    Sub-requests that fail with a retryable error (rate limit, 5xx) are re-batched
+    using the same backoff as _execute. Returns (responses, errors), both keyed by
+    id; errors holds the sub-requests that still failed.
+    """
+    responses: Dict[str, Any] = {}
+    errors: Dict[str, Exception] = {}
+
+    def _store(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = exception
+        else:
+            responses[request_id] = response
+
+    pending = dict(requests)
+    for attempt in Retrying(**_RETRY_POLICY):
+        with attempt:
+            # Skip anything already answered before an earlier batch call failed outright
+            pending = {rid: req for rid, req in pending.items() if rid not in responses}
+            for rid in pending:
+                errors.pop(rid, None)
+
+            ids = list(pending)
+            for start in range(0, len(ids), _BATCH_LIMIT):
+                batch = service.new_batch_http_request(callback=_store)
+                for rid in ids[start:start + _BATCH_LIMIT]:
+                    batch.add(pending[rid], request_id=rid)
+                batch.execute()
+
+            pending = {rid: req for rid, req in pending.items() if _is_retryable(errors.get(rid))}
+            # Raising one of the sub-request errors makes tenacity back off (honouring its Retry-After)
+            if pending and attempt.retry_state.attempt_number < _MAX_ATTEMPTS:
+                raise errors[next(iter(pending))]
+
+    return responses, errors
 
 
 def _get_headers_map(headers: List[Dict[str, str]]) -> Dict[str, str]:
     return {h.get("name"): h.get("value") for h in headers}
 
 
-def _extract_text_from_payload(payload: Dict[str, Any]) -> str:
-    """Recursively extract the text/plain content from a message payload."""
+def _parse_payload(payload: Dict[str, Any]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Walk a message payload once, returning its text/plain body and its attachment parts.
+
+    Walks the MIME tree with an explicit stack (depth-first, in part order) and
+    collects the decoded text bytes into one buffer that is decoded once at the end.
+    """
     if not payload:
-        return ""
+        return "", []
+
+    out = bytearray()
+    attachment_parts = []
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        body = part.get("body", {})
+        data = body.get("data")
 
-    mime_type = payload.get("mimeType", "")
-    body = payload.get("body", {})
-    parts = payload.get("parts", [])
+        # Any nested part with a filename and content is an attachment.
+        if part is not payload and part.get("filename") and (body.get("attachmentId") or data):
+            attachment_parts.append(part)
 
-    # If this payload is text/plain and has data, decode it.
-    if mime_type == "text/plain" and body.get("data"):
-        data = body.get("data")
-        try:
-            decoded = base64.urlsafe_b64decode(data + '==').decode("utf-8", errors="replace")
-            return decoded
-        except Exception:
-            return ""
+        # If this part is text/plain and has data, decode it.
+        if part.get("mimeType") == "text/plain" and data:
+            try:
+                decoded = base64.urlsafe_b64decode(data + '==')
+            except Exception:
+                decoded = b""
+            if decoded:
+                if out:
+                    out += b"\n"
+                out += decoded
 
-    # If multipart, walk children and concatenate text/plain parts.
-    texts = []
-    for part in parts:
-        part_text = _extract_text_from_payload(part)
-        if part_text:
-            texts.append(part_text)
+        # If multipart, visit children in their original order.
+        stack.extend(reversed(part.get("parts") or []))
 
-    return "\n".join(texts)
+    return out.decode("utf-8", errors="replace"), attachment_parts
+
+
+_METADATA_HEADERS = ["From", "To", "Subject", "Date"]
+
+# Every Gmail call below asks for a partial response ("fields") with only what we read.
+
+# Non text/* MIME types whose attachments are still worth previewing.
+_TEXT_LIKE_MIME_TYPES = {"application/json", "application/xml"}
+
+
+def _is_text_like(mime_type: str) -> bool:
+    return bool(mime_type) and (mime_type.startswith("text/") or mime_type in _TEXT_LIKE_MIME_TYPES)
+
+
+def _batch_get_metadata(service, message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Fetch metadata for many messages using Gmail batch HTTP requests.
+
+    Returns a dict keyed by message id. Raises the first sub-request error that
+    survived retries, rather than returning blank summaries for those messages.
+    """
+    requests = {
+        msg_id: service.users().messages().get(
+            userId="me",
+            id=msg_id,
+            format="metadata",
+            metadataHeaders=_METADATA_HEADERS,
+            fields="id,threadId,snippet,payload/headers"
+        )
+        for msg_id in message_ids
+    }
+    fetched, errors = _batch_execute(service, requests)
+    if errors:
+        raise next(iter(errors.values()))
+    return fetched
 
 
 def list_unread_emails(max_results: int = 5) -> List[Dict[str, Any]]:
@@ -40,24 +204,21 @@ def list_unread_emails(max_results: int = 5) -> List[Dict[str, Any]]:
 
     This is suitable for quickly answering questions like "Do I have any unread emails?" or "What is the new email I got?".
     """
-    service = get_gmail_service()
+    service = _service()
 
-    result = service.users().messages().list(
+    result = _execute(service.users().messages().list(
         userId="me",
         labelIds=["UNREAD"],
-        maxResults=max_results
-    ).execute()
+        maxResults=max_results,
+        fields="messages(id,threadId)"
+    ))
 
     messages = result.get("messages", [])
+    fetched = _batch_get_metadata(service, [msg["id"] for msg in messages])
     summaries = []
 
     for msg in messages:
-        data = service.users().messages().get(
-            userId="me",
-            id=msg["id"],
-            format="metadata",
-            metadataHeaders=["From", "To", "Subject", "Date"]
-        ).execute()
+        data = fetched.get(msg["id"], {})
 
         headers = _get_headers_map(data.get("payload", {}).get("headers", []))
         snippet = data.get("snippet", "")
@@ -81,61 +242,70 @@ def get_email_full(message_id: str) -> Dict[str, Any]:
     - attachments (list of {filename, mimeType, attachmentId, size, content_preview})
 
     Attachments content is fetched for text-like attachments and a short preview is included to keep payloads small.
+    Results are cached per message id for a few minutes, unless an attachment preview failed to load.
     """
-    service = get_gmail_service()
-    data = service.users().messages().get(
+    with _EMAIL_CACHE_LOCK:
+        cached = _EMAIL_CACHE.get(message_id)
+    if cached is not None:
+        return cached
+
+    service = _service()
+    data = _execute(service.users().messages().get(
         userId="me",
         id=message_id,
-        format="full"
-    ).execute()
+        format="full",
+        fields="id,threadId,snippet,payload"
+    ))
 
-    headers = _get_headers_map(data.get("payload", {}).get("headers", []))
-    body = _extract_text_from_payload(data.get("payload", {}))
+    payload = data.get("payload", {})
+    headers = _get_headers_map(payload.get("headers", []))
+    body, attachment_parts = _parse_payload(payload)
 
     attachments = []
-    # Walk parts to find attachments
-    def _walk_parts(parts):
-        for p in parts or []:
-            filename = p.get("filename")
-            body = p.get("body", {})
-            part_id = p.get("partId")
-            mime_type = p.get("mimeType")
-
-            if filename and body and (body.get("attachmentId") or body.get("data")):
-                attachment_info = {
-                    "filename": filename,
-                    "mimeType": mime_type,
-                    "attachmentId": body.get("attachmentId"),
-                    "size": body.get("size")
-                }
-                # Try to fetch small text attachments content preview
-                if body.get("attachmentId"):
-                    try:
-                        att = service.users().messages().attachments().get(
-                            userId="me",
-                            messageId=message_id,
-                            id=body.get("attachmentId")
-                        ).execute()
-                        att_data = att.get("data")
-                        if att_data:
-                            decoded = base64.urlsafe_b64decode(att_data + '==').decode("utf-8", errors="replace")
-                            # Keep a short preview
-                            attachment_info["content_preview"] = decoded[:1000]
-                        else:
-                            attachment_info["content_preview"] = None
-                    except Exception:
-                        attachment_info["content_preview"] = None
-
-                attachments.append(attachment_info)
-
-            # Recurse into nested parts
-            child_parts = p.get("parts")
-            if child_parts:
-                _walk_parts(child_parts)
-
-    _walk_parts(data.get("payload", {}).get("parts", []))
-
-    return {
+    pending = []
+    for part in attachment_parts:
+        part_body = part.get("body", {})
+        attachment_info = {
+            "filename": part.get("filename"),
+            "mimeType": part.get("mimeType"),
+            "attachmentId": part_body.get("attachmentId"),
+            "size": part_body.get("size")
+        }
+        if part_body.get("attachmentId"):
+            attachment_info["content_preview"] = None
+            # Only download text-like attachments; binary ones (images, PDFs, ...) get no preview
+            if _is_text_like(part.get("mimeType")):
+                pending.append(attachment_info)
+        attachments.append(attachment_info)
+
+    # Fetch text previews for all attachments in batched round trips
+    requests = {
+        str(i): service.users().messages().attachments().get(
+            userId="me",
+            messageId=message_id,
+            id=info["attachmentId"],
+            fields="data"
+        )
+        for i, info in enumerate(pending)
+    }
+    try:
+        previews, errors = _batch_execute(service, requests)
+        previews_complete = not errors
+    except Exception:
+        previews, previews_complete = {}, False
+
+    for request_id, response in previews.items():
+        att_data = response.get("data") if response else None
+        if not att_data:
+            continue
+        try:
+            decoded = base64.urlsafe_b64decode(att_data + '==').decode("utf-8", errors="replace")
+        except Exception:
+            continue
+        # Keep a short preview
+        pending[int(request_id)]["content_preview"] = decoded[:1000]
+
+    result = {
         "id": data.get("id"),
         "threadId": data.get("threadId"),
         "headers": headers,
@@ -143,26 +313,28 @@ def get_email_full(message_id: str) -> Dict[str, Any]:
         "attachments": attachments,
         "snippet": data.get("snippet")
     }
+    # Don't cache a result with previews missing because of a (possibly transient) fetch error
+    if previews_complete:
+        with _EMAIL_CACHE_LOCK:
+            _EMAIL_CACHE[message_id] = result
+    return result
 
 
 def search_emails(query: str, max_results: int = 10) -> List[Dict[str, Any]]:
     """Search the user's mailbox using Gmail query language and return short summaries of matching messages."""
-    service = get_gmail_service()
-    result = service.users().messages().list(
+    service = _service()
+    result = _execute(service.users().messages().list(
         userId="me",
         q=query,
-        maxResults=max_results
-    ).execute()
+        maxResults=max_results,
+        fields="messages(id,threadId)"
+    ))
 
     messages = result.get("messages", [])
+    fetched = _batch_get_metadata(service, [msg["id"] for msg in messages])
     results = []
     for msg in messages:
-        data = service.users().messages().get(
-            userId="me",
-            id=msg["id"],
-            format="metadata",
-            metadataHeaders=["From", "To", "Subject", "Date"]
-        ).execute()
+        data = fetched.get(msg["id"], {})
         headers = _get_headers_map(data.get("payload", {}).get("headers", []))
         results.append({
             "id": msg["id"],
@@ -174,34 +346,37 @@ def search_emails(query: str, max_results: int = 10) -> List[Dict[str, Any]]:
     return results
 
 
-def build_context_for_llm(email: Dict[str, Any], include_attachments: bool = True, attachment_preview_chars: int = 500) -> str:
-    """Build a plain-text context string for the LLM from an email dict produced by get_email_full or list/search results.
+# Backwards-compatible alias used by existing code
+def get_unread_emails(max_results=5):
+    return list_unread_emails(max_results=max_results)
+
+
+def warm_up() -> None:
+    """Build the Gmail service and make one cheap call so the TLS connection,
+    discovery document and access token are ready before the first tool call.
 
-    The returned string is intentionally concise so the client can pass it as the LLM prompt context when answering user questions about Gmail (e.g., "any mail from Google?", "open the latest mail and summarize", "read attachment and summarize").
+    Skipped when there is no saved token yet, so server start never opens the OAuth flow.
     """
-    headers = email.get("headers", {})
-    subject = headers.get("Subject", "(no subject)")
-    sender = headers.get("From", "(unknown sender)")
-    date = headers.get("Date", "(unknown date)")
-    snippet = email.get("snippet", "")
-    body = email.get("body") or snippet or ""
+    if not os.path.exists("token.json"):
+        return
+    try:
+        _execute(_service().users().getProfile(userId="me", fields="emailAddress"))
+    except Exception:
+        pass
 
-    ctx = [f"Subject: {subject}", f"From: {sender}", f"Date: {date}", "", "Body:", body[:2000]]
 
-    if include_attachments:
-        atts = email.get("attachments", [])
-        if atts:
-            ctx.append("\nAttachments:")
-            for a in atts:
-                preview = a.get("content_preview")
-                if preview:
-                    ctx.append(f"- {a.get('filename')} ({a.get('mimeType')}): {preview[:attachment_preview_chars]}")
-                else:
-                    ctx.append(f"- {a.get('filename')} ({a.get('mimeType')}): (no text preview available)")
+# Async variants for event-loop callers (the MCP server). Each runs the blocking
+# Gmail call in a worker thread, gated by _GMAIL_SEM.
+async def get_unread_emails_async(max_results=5):
+    async with _GMAIL_SEM:
+        return await asyncio.to_thread(list_unread_emails, max_results=max_results)
 
-    return "\n".join(ctx)
 
+async def search_emails_async(query: str, max_results: int = 10) -> List[Dict[str, Any]]:
+    async with _GMAIL_SEM:
+        return await asyncio.to_thread(search_emails, query, max_results=max_results)
 
-# Backwards-compatible alias used by existing code
-def get_unread_emails(max_results=5):
-    return list_unread_emails(max_results=max_results)
+
+async def get_email_full_async(message_id: str) -> Dict[str, Any]:
+    async with _GMAIL_SEM:
+        return await asyncio.to_thread(get_email_full, message_id)
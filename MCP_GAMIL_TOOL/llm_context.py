@@ -0,0 +1,34 @@
+"""Plain-text formatting of Gmail tool output for LLM prompts.
+
+Kept free of Gmail/Google dependencies so both the MCP server side (gmail_tools)
+and the HTTP client can import it.
+"""
+from typing import Dict, Any
+
+
+def build_context_for_llm(email: Dict[str, Any], include_attachments: bool = True, attachment_preview_chars: int = 500) -> str:
+    """Build a plain-text context string for the LLM from an email dict produced by get_email_full or list/search results.
+
+    The returned string is intentionally concise so the client can pass it as the LLM prompt context when answering user questions about Gmail (e.g., "any mail from Google?", "open the latest mail and summarize", "read attachment and summarize").
+    """
+    headers = email.get("headers", {})
+    subject = headers.get("Subject", "(no subject)")
+    sender = headers.get("From", "(unknown sender)")
+    date = headers.get("Date", "(unknown date)")
+    snippet = email.get("snippet", "")
+    body = email.get("body") or snippet or ""
+
+    ctx = [f"Subject: {subject}", f"From: {sender}", f"Date: {date}", "", "Body:", body[:2000]]
+
+    if include_attachments:
+        atts = email.get("attachments", [])
+        if atts:
+            ctx.append("\nAttachments:")
+            for a in atts:
+                preview = a.get("content_preview")
+                if preview:
+                    ctx.append(f"- {a.get('filename')} ({a.get('mimeType')}): {preview[:attachment_preview_chars]}")
+                else:
+                    ctx.append(f"- {a.get('filename')} ({a.get('mimeType')}): (no text preview available)")
+
+    return "\n".join(ctx)
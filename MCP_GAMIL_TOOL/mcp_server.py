@@ -1,13 +1,27 @@
+import asyncio
+import os
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse
+import uvicorn
 from pydantic import BaseModel
 from typing import Optional
-from gmail_tools import get_unread_emails, search_emails, get_email_full
+from gmail_tools import get_unread_emails_async, search_emails_async, get_email_full_async, warm_up
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Pre-warm the Gmail connection in the background; startup doesn't wait for it
+    warm = asyncio.create_task(asyncio.to_thread(warm_up))
+    yield
+    warm.cancel()
+
+
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
 
 @app.post("/tools/get_unread_emails")
-def unread_emails():
-    emails = get_unread_emails()
+async def unread_emails():
+    emails = await get_unread_emails_async()
     return {
         "count": len(emails),
         "emails": emails
@@ -18,8 +32,8 @@ class SearchRequest(BaseModel):
     max_results: Optional[int] = 10
 
 @app.post("/tools/search_emails")
-def search_emails_endpoint(req: SearchRequest):
-    results = search_emails(req.query, max_results=req.max_results)
+async def search_emails_endpoint(req: SearchRequest):
+    results = await search_emails_async(req.query, max_results=req.max_results)
     return {
         "count": len(results),
         "results": results
@@ -29,8 +43,17 @@ class MessageRequest(BaseModel):
     message_id: str
 
 @app.post("/tools/get_email_full")
-def get_email_full_endpoint(req: MessageRequest):
-    email = get_email_full(req.message_id)
+async def get_email_full_endpoint(req: MessageRequest):
+    email = await get_email_full_async(req.message_id)
     if not email:
         raise HTTPException(status_code=404, detail="Message not found")
     return email
+
+
+if __name__ == "__main__":
+    # uvloop + httptools are the fast event loop / HTTP parser for uvicorn.
+    # Bound to localhost only: this server exposes the user's mailbox.
+    # One worker by default: the Gmail concurrency cap and the email cache are
+    # per process, so MCP_WORKERS=N multiplies the quota usage by N and splits the cache.
+    workers = int(os.getenv("MCP_WORKERS", "1"))
+    uvicorn.run("mcp_server:app", host="127.0.0.1", port=8000, loop="uvloop", http="httptools", workers=workers)
@@ -0,0 +1,48 @@
+"""Local routing of obviously-classifiable Gmail questions to an MCP tool.
+
+Kept free of network/LLM dependencies so the client can skip the routing LLM
+call for these questions, and so the routes can be checked on their own.
+"""
+import re
+from typing import Any, Dict, Optional, Tuple
+
+# (pattern, tool) pairs tried in order before asking the LLM to pick a tool.
+# Each route only fires on an unambiguous match: a Gmail-shaped message id (hex),
+# an email address or quoted name after "from", or the word "unread".
+_UNREAD_RE = re.compile(r"\bunread\b", re.I)
+_ANY_FROM_RE = re.compile(r"\bfrom\b", re.I)
+_ANY_MESSAGE_ID_RE = re.compile(r"\bmessage[_ -]?id\b", re.I)
+_ROUTES = [
+    (re.compile(r"\bmessage[_ -]?id\b(?:\s+is)?[:\s]+([0-9a-f]{10,})\b", re.I), "get_email_full"),
+    (re.compile(r"""\bfrom\s+(?:"([^"]+)"|'([^']+)'|([\w.+-]+@[\w-]+(?:\.[\w-]+)+))""", re.I), "search_emails"),
+    (_UNREAD_RE, "get_unread_emails"),
+]
+
+
+def route_locally(question: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    """Pick a tool for obviously-classifiable questions without an LLM round trip.
+
+    Returns (tool_name, args) on a match, otherwise None.
+    """
+    for pattern, tool_name in _ROUTES:
+        m = pattern.search(question)
+        if tool_name == "get_email_full":
+            if m:
+                return tool_name, {"message_id": m.group(1)}
+            if _ANY_MESSAGE_ID_RE.search(question):
+                # Mentions a message id without giving one ("what is the message id of ...")
+                return None
+            continue
+        if not m:
+            continue
+        if tool_name == "search_emails":
+            sender = next(g for g in m.groups() if g).strip()
+            query = f'from:"{sender}"'
+            if _UNREAD_RE.search(question):
+                query = f"is:unread {query}"
+            return tool_name, {"query": query, "max_results": 5}
+        if _ANY_FROM_RE.search(question):
+            # Some other "from ..." qualifier (a name, a time range) that the LLM should interpret
+            return None
+        return tool_name, {"max_results": 5}
+    return None
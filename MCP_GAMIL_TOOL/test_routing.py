@@ -0,0 +1,30 @@
+"""Checks for the local question router (run with: python -m pytest test_routing.py)."""
+from routing import route_locally
+
+
+def test_message_id_route_takes_gmail_shaped_ids():
+    assert route_locally("open message id: 18c2f4a9b7e6d501") == ("get_email_full", {"message_id": "18c2f4a9b7e6d501"})
+    assert route_locally("message id is 18c2f4a9b7e6d501") == ("get_email_full", {"message_id": "18c2f4a9b7e6d501"})
+
+
+def test_message_id_without_an_id_falls_back_to_llm():
+    assert route_locally("What is the message id of the latest email from bob@x.com?") is None
+    assert route_locally("Did I get the message ID for my order?") is None
+    assert route_locally("What's the message id format?") is None
+    assert route_locally("message id is 18c2") is None
+
+
+def test_from_route_needs_an_unambiguous_sender():
+    assert route_locally("Show me mails from alice@example.com.") == (
+        "search_emails", {"query": 'from:"alice@example.com"', "max_results": 5})
+    assert route_locally('emails from "John Smith"') == ("search_emails", {"query": 'from:"John Smith"', "max_results": 5})
+    assert route_locally("unread mail from bob@x.com?") == (
+        "search_emails", {"query": 'is:unread from:"bob@x.com"', "max_results": 5})
+    assert route_locally("What did I get from the bank yesterday?") is None
+    assert route_locally("Summarize emails from John Smith") is None
+    assert route_locally("unread emails from last week") is None
+
+
+def test_unread_route():
+    assert route_locally("Any unread emails?") == ("get_unread_emails", {"max_results": 5})
+    assert route_locally("What is the weather?") is None